@@ -332,7 +332,7 @@ Format the summary into approximately 50 concise but detailed lines, covering ev
         const segmentationData = await processImageSegmentation();
         
         if (segmentationData.visualization) {
-          setVisualizationImage(`data:image/png;base64,${segmentationData.visualization}`);
+          setVisualizationImage(`data:image/jpeg;base64,${segmentationData.visualization}`);
         }
         
         setSegmentationStats(segmentationData);
@@ -43,7 +43,7 @@ interface WallData {
     yolo_score: number;
     sam_score: number;
   };
-  mask_base64: string;
+  mask_url: string;
 }
 
 interface WallAnalysisResult {
@@ -450,7 +450,7 @@ const MeasurementAnalyzer = () => {
   // Helper function to download images
   const downloadImage = (imageData: string, filename: string) => {
     const link = document.createElement('a');
-    link.href = `data:image/png;base64,${imageData}`;
+    link.href = `data:image/jpeg;base64,${imageData}`;
     link.download = filename;
     document.body.appendChild(link);
     link.click();
@@ -742,7 +742,7 @@ const MeasurementAnalyzer = () => {
                         <Button
                           variant="outline"
                           size="sm"
-                          onClick={() => downloadImage(wallAnalysisResult.measurement_visualization, 'wall_analysis.png')}
+                          onClick={() => downloadImage(wallAnalysisResult.measurement_visualization, 'wall_analysis.jpg')}
                         >
                           <Download className="w-4 h-4 mr-1" />
                           Download
@@ -750,7 +750,7 @@ const MeasurementAnalyzer = () => {
                       </div>
                       <div className="flex justify-center bg-gray-50 p-4 rounded-lg">
                         <img
-                          src={`data:image/png;base64,${wallAnalysisResult.measurement_visualization}`}
+                          src={`data:image/jpeg;base64,${wallAnalysisResult.measurement_visualization}`}
                           alt="Wall Analysis"
                           className="max-w-full h-auto max-h-[600px] object-contain rounded-lg border shadow-sm"
                         />
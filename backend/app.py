@@ -1,16 +1,25 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException
+import asyncio
+import base64
+from fastapi import FastAPI, File, UploadFile, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-import numpy as np
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, Response
 import logging
+import os
 from dotenv import load_dotenv
 load_dotenv()
-from helperClass import WallAnalysisService
+from helperClass import InferenceBatcher, BlobStore, get_wall_analysis_service
+from schemas import AnalyzeResponse, AnalyzeSummary, DepthRange, ImageDimensions, WallOut
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Wall Analysis API with Depth Estimation", version="2.0.0")
+# orjson serializes NumPy scalars natively and is much faster on the large base64 payloads
+app = FastAPI(
+    title="Wall Analysis API with Depth Estimation",
+    version="2.0.0",
+    default_response_class=ORJSONResponse,
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -19,12 +28,108 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Compression runs on the event loop; the payloads are mostly base64 of already-compressed images,
+# where level 1 recovers nearly all of the base64 overhead at a fraction of level 9's CPU cost
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=1)
+
+
+
+
+# The service and batcher are created per worker process at startup, so the uvicorn
+# supervisor never loads the models when running with several workers
+wall_analysis_service = None
+inference_batcher = None
+
+# Masks are served from /blob/{id} rather than inlined as base64 in /analyze responses.
+# Set BLOB_DIR to a shared directory when running more than one worker.
+blob_store = BlobStore(
+    ttl_seconds=float(os.getenv("BLOB_TTL_SECONDS", "300")),
+    directory=os.getenv("BLOB_DIR"),
+    max_bytes=int(os.getenv("BLOB_MAX_MB", "256")) * 1024 * 1024,
+)
+
+@app.on_event("startup")
+async def start_inference_batcher():
+    global wall_analysis_service, inference_batcher
+    wall_analysis_service = get_wall_analysis_service()
+    # Coalesce concurrent requests into batched YOLO/SAM passes
+    inference_batcher = InferenceBatcher(
+        wall_analysis_service,
+        max_batch_size=int(os.getenv("INFERENCE_BATCH_SIZE", "16")),
+        max_wait_ms=float(os.getenv("INFERENCE_BATCH_WAIT_MS", "10")),
+    )
+    inference_batcher.start()
+
+@app.on_event("shutdown")
+async def stop_inference_batcher():
+    await inference_batcher.stop()
 
+# Upload limits: reject oversized bodies while reading and sniff the real format from magic bytes
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(25 * 1024 * 1024)))
+UPLOAD_CHUNK_BYTES = 1024 * 1024
 
+def is_supported_image(header: bytes) -> bool:
+    """Check for JPEG, PNG, WebP or GIF magic bytes"""
+    return (
+        header[:3] == b'\xff\xd8\xff'
+        or header[:8] == b'\x89PNG\r\n\x1a\n'
+        or (header[:4] == b'RIFF' and header[8:12] == b'WEBP')
+        or header[:6] in (b'GIF87a', b'GIF89a')
+    )
 
+async def read_image_upload(file: UploadFile) -> bytes:
+    """Read an upload in chunks, enforcing MAX_UPLOAD_BYTES and a JPEG/PNG/WebP/GIF signature"""
+    buffer = bytearray()
+    while True:
+        chunk = await file.read(UPLOAD_CHUNK_BYTES)
+        if not chunk:
+            break
+        if not buffer and not is_supported_image(chunk[:32]):
+            raise HTTPException(status_code=415, detail="Only JPEG, PNG, WebP and GIF images are supported")
+        buffer += chunk
+        if len(buffer) > MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail=f"Image exceeds the {MAX_UPLOAD_BYTES} byte upload limit")
+    
+    if not buffer:
+        raise HTTPException(status_code=400, detail="Uploaded file is empty")
+    
+    return bytes(buffer)
 
-# Initialize the service
-wall_analysis_service = WallAnalysisService()
+def _retrieve_task_exception(task: asyncio.Task):
+    if not task.cancelled():
+        task.exception()
+
+async def _segment_pipeline(file_content: bytes, with_depth: bool = False) -> tuple:
+    """Shared /analyze and /upload path: preprocess, then batched wall detection and segmentation.
+
+    With with_depth, the depth map lookup/generation is started as a task before detection so
+    the two overlap. Returns (image, wall_detections, wall_segments, depth_task or None).
+    """
+    logger.info("Step 1: Preprocessing image...")
+    image, image_tensor = await asyncio.to_thread(wall_analysis_service.preprocess_image, file_content)
+    logger.info(f"Image preprocessed - OpenCV shape: {image.shape}")
+    
+    # Content hash keys both the depth map and SAM embedding caches
+    image_hash = wall_analysis_service.content_hash(file_content)
+    
+    depth_task = None
+    if with_depth:
+        logger.info("Step 2-4: Generating depth map while detecting and segmenting walls...")
+        depth_task = asyncio.create_task(
+            asyncio.to_thread(wall_analysis_service.get_or_generate_depth_map, image_hash, image_tensor)
+        )
+        # Mark failures as retrieved so early returns don't log unhandled task errors
+        depth_task.add_done_callback(_retrieve_task_exception)
+    else:
+        logger.info("Step 2-3: Detecting and segmenting walls...")
+    
+    try:
+        wall_detections, wall_segments = await inference_batcher.submit(image, image_hash)
+    except BaseException:
+        if depth_task is not None:
+            depth_task.cancel()
+        raise
+    return image, wall_detections, wall_segments, depth_task
 
 @app.get("/")
 async def root():
@@ -42,180 +147,147 @@ async def health_check():
         }
     }
 
-@app.post("/analyze")
-async def analyze_walls(file: UploadFile = File(...)):
+@app.post("/analyze", response_model=AnalyzeResponse, response_model_exclude_none=True)
+async def analyze_walls(request: Request, file: UploadFile = File(...), viz: bool = Query(True, description="Render visualization images")):
     """Upload image and perform complete wall analysis with depth estimation"""
     try:
-        if not file.content_type.startswith('image/'):
-            raise HTTPException(status_code=400, detail="Only image files are supported")
-        
-        file_content = await file.read()
+        file_content = await read_image_upload(file)
         
         logger.info(f"Processing uploaded file: {file.filename}")
         logger.info(f"File size: {len(file_content)} bytes")
         
-        # Step 1: Preprocess image
-        logger.info("Step 1: Preprocessing image...")
-        image, pil_image = wall_analysis_service.preprocess_image(file_content)
-        logger.info(f"Image preprocessed - OpenCV shape: {image.shape}, PIL size: {pil_image.size}")
-        
-        # Step 2: Detect walls
-        logger.info("Step 2: Detecting walls...")
-        wall_detections = wall_analysis_service.detect_walls(image)
+        # Steps 1-4: preprocess, then depth estimation concurrently with detection and segmentation
+        image, wall_detections, wall_segments, depth_task = await _segment_pipeline(file_content, with_depth=True)
         
         if not wall_detections:
             logger.info("No walls detected, returning early response")
-            return JSONResponse(
-                content={
-                    "success": True,
-                    "message": "No walls detected in the image",
-                    "wall_count": 0,
-                    "walls": [],
-                    "segmentation_visualization": None,
-                    "measurement_visualization": None
-                }
-            )
+            # The depth map is not needed without walls
+            depth_task.cancel()
+            return AnalyzeResponse(success=True, message="No walls detected in the image", wall_count=0)
         
-        # Step 3: Segment walls
-        logger.info("Step 3: Segmenting walls...")
-        wall_segments = wall_analysis_service.segment_walls(image, wall_detections)
         logger.info(f"Wall segments created: {len(wall_segments)}")
         
-        # Step 4: Generate depth map
-        logger.info("Step 4: Generating depth map...")
+        # Step 4: Wait for the depth map
         try:
-            depth_map = wall_analysis_service.generate_depth_map(pil_image)
-            logger.info(f"Depth map generated successfully with shape: {depth_map.shape}")
+            depth_map, depth_cache_hit = await depth_task
+            logger.info(f"Depth map ready with shape: {depth_map.shape}")
         except Exception as depth_error:
             logger.error(f"Depth map generation failed: {str(depth_error)}")
             # Return basic segmentation results if depth analysis fails
-            segmentation_viz = wall_analysis_service.create_visualization(image, wall_segments)
-            return JSONResponse(
-                content={
-                    "success": False,
-                    "message": f"Wall segmentation completed but depth analysis failed: {str(depth_error)}",
-                    "wall_count": len(wall_segments),
-                    "walls": [],
-                    "segmentation_visualization": segmentation_viz,
-                    "measurement_visualization": None,
-                    "error_details": str(depth_error)
-                }
+            segmentation_viz = None
+            if viz:
+                segmentation_viz = await asyncio.to_thread(wall_analysis_service.create_visualization, image, wall_segments)
+            return AnalyzeResponse(
+                success=False,
+                message=f"Wall segmentation completed but depth analysis failed: {str(depth_error)}",
+                wall_count=len(wall_segments),
+                segmentation_visualization=segmentation_viz,
+                error_details=str(depth_error),
             )
         
         # Step 5: Analyze wall depths and calculate measurements
         logger.info("Step 5: Analyzing wall depths...")
         try:
-            wall_depth_analysis = wall_analysis_service.analyze_wall_depths(wall_segments, depth_map, image.shape)
+            wall_depth_analysis = await asyncio.to_thread(
+                wall_analysis_service.analyze_wall_depths, wall_segments, depth_map, image.shape
+            )
             logger.info(f"Wall depth analysis completed for {len(wall_depth_analysis)} walls")
         except Exception as analysis_error:
             logger.error(f"Wall depth analysis failed: {str(analysis_error)}")
             # Return basic segmentation if depth analysis fails
-            segmentation_viz = wall_analysis_service.create_visualization(image, wall_segments)
-            return JSONResponse(
-                content={
-                    "success": False,
-                    "message": f"Depth analysis failed: {str(analysis_error)}",
-                    "wall_count": len(wall_segments),
-                    "walls": [],
-                    "segmentation_visualization": segmentation_viz,
-                    "measurement_visualization": None,
-                    "error_details": str(analysis_error)
-                }
+            segmentation_viz = None
+            if viz:
+                segmentation_viz = await asyncio.to_thread(wall_analysis_service.create_visualization, image, wall_segments)
+            return AnalyzeResponse(
+                success=False,
+                message=f"Depth analysis failed: {str(analysis_error)}",
+                wall_count=len(wall_segments),
+                segmentation_visualization=segmentation_viz,
+                error_details=str(analysis_error),
             )
         
-        # Step 6: Create visualizations
-        logger.info("Step 6: Creating visualizations...")
-        try:
-            # Only create measurement visualization (which includes segmentation)
-            measurement_viz = wall_analysis_service.create_measurement_visualization(image, wall_depth_analysis)
-            logger.info("Measurement visualization created")
-            # Use the same visualization for both
-            segmentation_viz = measurement_viz
-        except Exception as viz_error:
-            logger.error(f"Visualization creation failed: {str(viz_error)}")
-            # Continue without visualizations
-            segmentation_viz = None
-            measurement_viz = None
+        # Step 6: Create visualizations (skipped for API-only callers with ?viz=false)
+        segmentation_viz = None
+        measurement_viz = None
+        if viz:
+            logger.info("Step 6: Creating visualizations...")
+            try:
+                # Only create measurement visualization (which includes segmentation)
+                measurement_viz = await asyncio.to_thread(
+                    wall_analysis_service.create_measurement_visualization, image, wall_depth_analysis
+                )
+                logger.info("Measurement visualization created")
+                # Use the same visualization for both
+                segmentation_viz = measurement_viz
+            except Exception as viz_error:
+                logger.error(f"Visualization creation failed: {str(viz_error)}")
+                # Continue without visualizations
         
         # Step 7: Prepare response
         logger.info("Step 7: Preparing response...")
-        total_area = sum([analysis['area_square_meters'] for analysis in wall_depth_analysis])
-        avg_yolo_confidence = np.mean([analysis['yolo_score'] for analysis in wall_depth_analysis])
-        avg_sam_score = np.mean([analysis['sam_score'] for analysis in wall_depth_analysis])
+        wall_count = len(wall_depth_analysis)
+        # Walls without usable depth or corners are dropped, so the list can be empty here
+        total_area = sum(a['area_square_meters'] for a in wall_depth_analysis)
+        avg_yolo_confidence = sum(a['yolo_score'] for a in wall_depth_analysis) / wall_count if wall_count else 0.0
+        avg_sam_score = sum(a['sam_score'] for a in wall_depth_analysis) / wall_count if wall_count else 0.0
+        # Device reduction waits on the GPU, so keep it off the event loop
+        depth_min, depth_max, depth_mean = await asyncio.to_thread(wall_analysis_service.depth_range, depth_map)
+        # Disk-backed puts do file I/O, so store the masks off the event loop
+        mask_ids = await asyncio.to_thread(
+            blob_store.put_many, [analysis['mask_png'] for analysis in wall_depth_analysis], 'image/png'
+        )
         
-        response_data = {
-            "success": True,
-            "message": f"Successfully analyzed {len(wall_depth_analysis)} walls with depth estimation",
-            "wall_count": len(wall_depth_analysis),
-            "walls": [
-                {
-                    "wall_id": analysis['wall_id'],
-                    "corners": analysis['corners'],
-                    "depth_stats": {
-                        "min_depth": analysis['min_depth'],
-                        "max_depth": analysis['max_depth'],
-                        "mean_depth": analysis['mean_depth'],
-                        "median_depth": analysis['median_depth'],
-                        "std_depth": analysis['std_depth']
-                    },
-                    "measurements": {
-                        "area_square_meters": analysis['area_square_meters'],
-                        "area_pixels": analysis['area_pixels'],
-                        "dimensions": analysis['dimensions']
-                    },
-                    "scores": {
-                        "yolo_score": analysis['yolo_score'],
-                        "sam_score": analysis['sam_score']
-                    },
-                    "mask_base64": analysis['mask_base64']
-                } for analysis in wall_depth_analysis
+        response = AnalyzeResponse(
+            success=True,
+            message=f"Successfully analyzed {wall_count} walls with depth estimation",
+            wall_count=wall_count,
+            walls=[
+                WallOut.from_analysis(analysis, mask_url=str(request.url_for("get_blob", blob_id=mask_id)))
+                for analysis, mask_id in zip(wall_depth_analysis, mask_ids)
             ],
-            "segmentation_visualization": segmentation_viz,
-            "measurement_visualization": measurement_viz,
-            "summary": {
-                "total_wall_area_square_meters": float(total_area),
-                "average_yolo_confidence": float(avg_yolo_confidence),
-                "average_sam_score": float(avg_sam_score),
-                "depth_range": {
-                    "min": float(np.min(depth_map)),
-                    "max": float(np.max(depth_map)),
-                    "mean": float(np.mean(depth_map))
-                },
-                "image_dimensions": {
-                    "width": int(image.shape[1]),
-                    "height": int(image.shape[0])
-                }
-            }
-        }
+            segmentation_visualization=segmentation_viz,
+            measurement_visualization=measurement_viz,
+            cache_hit=depth_cache_hit,
+            summary=AnalyzeSummary(
+                total_wall_area_square_meters=total_area,
+                average_yolo_confidence=avg_yolo_confidence,
+                average_sam_score=avg_sam_score,
+                depth_range=DepthRange(min=depth_min, max=depth_max, mean=depth_mean),
+                image_dimensions=ImageDimensions(width=image.shape[1], height=image.shape[0]),
+            ),
+        )
         
         logger.info(f"Successfully analyzed {file.filename}: {len(wall_depth_analysis)} walls, total area: {total_area:.2f} m²")
         logger.info("Analysis completed successfully, returning response")
-        return JSONResponse(content=response_data)
+        return response
         
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error processing analysis: {str(e)}")
-        logger.error(f"Error type: {type(e).__name__}")
-        import traceback
-        logger.error(f"Full traceback: {traceback.format_exc()}")
+        logger.exception(f"Error processing analysis: {type(e).__name__}: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error analyzing image: {str(e)}")
 
+@app.get("/blob/{blob_id}")
+async def get_blob(blob_id: str):
+    """Serve a mask image referenced by a mask_url in an /analyze response"""
+    blob = await asyncio.to_thread(blob_store.get, blob_id)
+    if blob is None:
+        raise HTTPException(status_code=404, detail="Blob not found or expired")
+    data, media_type = blob
+    return Response(content=data, media_type=media_type)
+
 # Keep the original upload endpoint for backward compatibility
 @app.post("/upload")
-async def upload_and_segment(file: UploadFile = File(...)):
+async def upload_and_segment(file: UploadFile = File(...), viz: bool = Query(True, description="Render visualization image")):
     """Upload image and perform basic wall segmentation (legacy endpoint)"""
     try:
-        if not file.content_type.startswith('image/'):
-            raise HTTPException(status_code=400, detail="Only image files are supported")
-        
-        file_content = await file.read()
+        file_content = await read_image_upload(file)
         
         logger.info(f"Processing uploaded file: {file.filename}")
-        image, _ = wall_analysis_service.preprocess_image(file_content)
-        
-        wall_detections = wall_analysis_service.detect_walls(image)
+        image, wall_detections, wall_segments, _ = await _segment_pipeline(file_content)
         
         if not wall_detections:
-            return JSONResponse(
+            return ORJSONResponse(
                 content={
                     "success": True,
                     "message": "No walls detected in the image",
@@ -225,14 +297,16 @@ async def upload_and_segment(file: UploadFile = File(...)):
                 }
             )
         
-        wall_segments = wall_analysis_service.segment_walls(image, wall_detections)
-        
         # Create basic visualization
-        visualization_base64 = wall_analysis_service.create_visualization(image, wall_segments)
+        visualization_base64 = None
+        if viz:
+            visualization_base64 = await asyncio.to_thread(wall_analysis_service.create_visualization, image, wall_segments)
         
-        avg_yolo_confidence = np.mean([segment['yolo_score'] for segment in wall_segments])
-        avg_sam_score = np.mean([segment['sam_score'] for segment in wall_segments])
-        total_wall_area = sum([segment['mask_area_pixels'] for segment in wall_segments])
+        # wall_segments is non-empty here, so plain sums avoid NumPy's array coercion on tiny lists
+        segment_count = len(wall_segments)
+        avg_yolo_confidence = sum(segment['yolo_score'] for segment in wall_segments) / segment_count
+        avg_sam_score = sum(segment['sam_score'] for segment in wall_segments) / segment_count
+        total_wall_area = sum(segment['mask_area_pixels'] for segment in wall_segments)
         
         response_data = {
             "success": True,
@@ -241,7 +315,7 @@ async def upload_and_segment(file: UploadFile = File(...)):
             "walls": [
                 {
                     "wall_id": segment['wall_id'],
-                    "mask_base64": segment['mask_base64'],
+                    "mask_base64": base64.b64encode(segment['mask_png']).decode('utf-8'),
                     "sam_score": segment['sam_score'],
                     "yolo_score": segment['yolo_score'],
                     "bbox": segment['bbox'],
@@ -250,24 +324,37 @@ async def upload_and_segment(file: UploadFile = File(...)):
                 } for segment in wall_segments
             ],
             "visualization": visualization_base64,
+            "mask_format": "image/png;base64",
+            "visualization_format": "image/jpeg;base64",
             "summary": {
-                "average_yolo_confidence": float(avg_yolo_confidence),
-                "average_sam_score": float(avg_sam_score),
-                "total_wall_area_pixels": int(total_wall_area),
+                "average_yolo_confidence": avg_yolo_confidence,
+                "average_sam_score": avg_sam_score,
+                "total_wall_area_pixels": total_wall_area,
                 "image_dimensions": {
-                    "width": int(image.shape[1]),
-                    "height": int(image.shape[0])
+                    "width": image.shape[1],
+                    "height": image.shape[0]
                 }
             }
         }
         
         logger.info(f"Successfully processed {file.filename}: {len(wall_segments)} walls found")
-        return JSONResponse(content=response_data)
+        return ORJSONResponse(content=response_data)
         
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error processing upload: {str(e)}")
+        logger.exception(f"Error processing upload: {type(e).__name__}: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error processing image: {str(e)}")
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # uvloop + httptools come with uvicorn[standard]. Each worker loads its own copy of the models;
+    # run more than one only with CUDA MPS enabled so they share the GPU (see README)
+    uvicorn.run(
+        "app:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("UVICORN_WORKERS", "1")),
+    )
\ No newline at end of file
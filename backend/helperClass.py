@@ -1,42 +1,289 @@
+import os
+# Read when torch first initializes CUDA; lets the caching allocator grow segments in place instead of
+# fragmenting across varying image sizes. An explicit setting in the environment or .env wins.
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
 import cv2
 import numpy as np
 import torch
+import torch.nn.functional as F
+from numba import njit, prange
 from ultralytics import YOLO
 from segment_anything import sam_model_registry, SamPredictor
 from transformers import DepthProImageProcessorFast, DepthProForDepthEstimation
-import os
 import base64
+import hashlib
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from io import BytesIO
-from PIL import Image
+from PIL import Image, ImageOps
 from typing import List, Dict, Any
 import json
 from datetime import datetime
 import logging
+import asyncio
+import mimetypes
+import re
+import shutil
 
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Reassociation and contraction let the reductions vectorize; nnan/ninf are left out because the
+# kernels seed min/max with +/-inf, and those flags would let LLVM fold the comparisons away
+_FASTMATH_FLAGS = {'reassoc', 'contract', 'arcp'}
+
+
+@njit(cache=True, fastmath=_FASTMATH_FLAGS)
+def _depth_min_max_mean(depth_map):
+    """Single pass over a contiguous depth map returning (min, max, mean)"""
+    flat = depth_map.ravel()
+    min_depth = flat[0]
+    max_depth = flat[0]
+    total = 0.0
+    for value in flat:
+        if value < min_depth:
+            min_depth = value
+        if value > max_depth:
+            max_depth = value
+        total += value
+    return min_depth, max_depth, total / flat.size
+
+
+@njit(parallel=True, cache=True, fastmath=_FASTMATH_FLAGS)
+def _wall_depth_stats(depth_map, masks, counts):
+    """Per-wall sum, sum of squares, min, max and median of depth in one pass over each mask"""
+    # Per-wall masks rather than a label map, since SAM masks can overlap. counts holds each
+    # mask's pixel count, so the median buffer is sized to the wall rather than the frame.
+    n_walls, height, width = masks.shape
+    sums = np.zeros(n_walls, dtype=np.float64)
+    sums_sq = np.zeros(n_walls, dtype=np.float64)
+    mins = np.full(n_walls, np.inf)
+    maxs = np.full(n_walls, -np.inf)
+    medians = np.zeros(n_walls, dtype=np.float64)
+    for k in prange(n_walls):
+        values = np.empty(counts[k], dtype=depth_map.dtype)
+        count = 0
+        total = 0.0
+        total_sq = 0.0
+        min_depth = np.inf
+        max_depth = -np.inf
+        for y in range(height):
+            for x in range(width):
+                if masks[k, y, x]:
+                    value = depth_map[y, x]
+                    values[count] = value
+                    count += 1
+                    total += value
+                    total_sq += value * value
+                    if value < min_depth:
+                        min_depth = value
+                    if value > max_depth:
+                        max_depth = value
+        sums[k] = total
+        sums_sq[k] = total_sq
+        mins[k] = min_depth
+        maxs[k] = max_depth
+        if count > 0:
+            medians[k] = np.median(values[:count])
+    return sums, sums_sq, mins, maxs, medians
+
+
+# Hershey glyph advances at scale 1 and thickness 1; getTextSize adds 1 for the stroke
+_LABEL_GLYPH_ADVANCES = {
+    chr(code): cv2.getTextSize(chr(code), cv2.FONT_HERSHEY_SIMPLEX, 1.0, 1)[0][0] - 1
+    for code in range(32, 127)
+}
+_LABEL_HEIGHTS = {}
+
+
+def _label_size(text: str, font_scale: float, thickness: int) -> tuple:
+    """cv2.getTextSize width/height for FONT_HERSHEY_SIMPLEX, summed from the cached glyph advances"""
+    width = round(sum(_LABEL_GLYPH_ADVANCES[char] for char in text) * font_scale + thickness)
+    # Height depends only on scale and thickness, not on the text
+    height = _LABEL_HEIGHTS.get((font_scale, thickness))
+    if height is None:
+        height = cv2.getTextSize("0", cv2.FONT_HERSHEY_SIMPLEX, font_scale, thickness)[0][1]
+        _LABEL_HEIGHTS[(font_scale, thickness)] = height
+    return width, height
+
+
+class PinnedBufferPool:
+    """Fixed pool of page-locked host buffers used to stage host-to-device copies"""
+    
+    def __init__(self, pool_size: int, buffer_bytes: int):
+        self.buffer_bytes = buffer_bytes
+        self._free = [torch.empty(buffer_bytes, dtype=torch.uint8, pin_memory=True) for _ in range(pool_size)]
+        # (event, buffer) pairs whose async copy may still be reading the buffer
+        self._in_flight = []
+        self._available = threading.Condition()
+    
+    def _reclaim(self):
+        """Return buffers whose copies have completed to the free list; caller holds the lock"""
+        pending = []
+        for copy_done, buffer in self._in_flight:
+            if copy_done.query():
+                self._free.append(buffer)
+            else:
+                pending.append((copy_done, buffer))
+        self._in_flight = pending
+    
+    def _acquire(self) -> torch.Tensor:
+        """Check out a buffer, waiting on the oldest in-flight copy only when none are free"""
+        with self._available:
+            while True:
+                self._reclaim()
+                if self._free:
+                    return self._free.pop()
+                if self._in_flight:
+                    copy_done, buffer = self._in_flight.pop(0)
+                    break
+                # Every buffer is being staged by another thread
+                self._available.wait()
+        copy_done.synchronize()
+        return buffer
+    
+    def to_device(self, tensor: torch.Tensor, device: str) -> torch.Tensor:
+        """Copy a host tensor into a pinned buffer and DMA it to the device without a driver staging copy"""
+        nbytes = tensor.numel() * tensor.element_size()
+        if nbytes > self.buffer_bytes:
+            return tensor.to(device)
+        
+        # Blocks only when the pool is exhausted, so the pool size bounds pinned memory use
+        buffer = self._acquire()
+        try:
+            staging = buffer[:nbytes].view(tensor.dtype).view(tensor.shape)
+            staging.copy_(tensor)
+            device_tensor = staging.to(device, non_blocking=True)
+            stream = torch.cuda.current_stream(device)
+            # Keep the allocator from reusing the device memory before work queued on this stream is done
+            device_tensor.record_stream(stream)
+            copy_done = torch.cuda.Event()
+            copy_done.record(stream)
+        except Exception:
+            with self._available:
+                self._free.append(buffer)
+                self._available.notify()
+            raise
+        
+        # The buffer stays checked out until the copy lands; it is reclaimed lazily by a later call
+        with self._available:
+            self._in_flight.append((copy_done, buffer))
+            self._available.notify()
+        return device_tensor
+
+
+class ScratchBufferPool:
+    """Small pool of reusable host scratch arrays for full-size visualization images"""
+    
+    def __init__(self, pool_size: int):
+        self._sets = queue.Queue(maxsize=max(pool_size, 1))
+        for _ in range(pool_size):
+            self._sets.put({})
+    
+    def acquire(self) -> dict:
+        """Borrow a set of named scratch arrays, or a throwaway set when every pooled one is in use"""
+        try:
+            return self._sets.get_nowait()
+        except queue.Empty:
+            return {}
+    
+    def release(self, buffers: dict):
+        """Return a borrowed set; sets beyond the pool size are dropped"""
+        try:
+            self._sets.put_nowait(buffers)
+        except queue.Full:
+            pass
+    
+    @staticmethod
+    def array(buffers: dict, name: str, shape: tuple, dtype=np.uint8) -> np.ndarray:
+        """Named array from a borrowed set, reallocated only when the shape or dtype changes"""
+        buffer = buffers.get(name)
+        if buffer is None or buffer.shape != tuple(shape) or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype=dtype)
+            buffers[name] = buffer
+        return buffer
+
 
 class WallAnalysisService:
     def __init__(self):
         self.yolo_model = None
+        self.wall_class_id = None
         self.sam_model = None
         self.sam_predictor = None
         self.depth_processor = None
         self.depth_model = None
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        # TensorRT engines for YOLOv8 and DepthPro (CUDA only); falls back to PyTorch otherwise
+        self.use_trt = os.getenv("USE_TRT", "0") == "1" and self.device == "cuda"
+        self.trt_engine_dir = os.getenv("TRT_ENGINE_DIR", "trt_engines")
+        # LRU cache of depth maps keyed by image content hash
+        self.depth_cache_size = int(os.getenv("DEPTH_CACHE_SIZE", "64"))
+        self._depth_cache = OrderedDict()
+        self._depth_cache_lock = threading.Lock()
+        # Model calls arrive from several worker threads; torch.compile's guard checks and recompiles
+        # aren't thread-safe, and SamPredictor keeps per-image state between set_image and predict
+        self._depth_model_lock = threading.Lock()
+        self._sam_lock = threading.Lock()
+        # LRU cache of SAM image embeddings keyed by image content hash (device memory, ~4MB each for ViT-H)
+        self.sam_cache_size = int(os.getenv("SAM_CACHE_SIZE", "16"))
+        self._sam_cache = OrderedDict()
+        # Separate non-default streams so DepthPro kernels overlap with the YOLO/SAM chain
+        self.depth_stream = torch.cuda.Stream() if self.device == "cuda" else None
+        self.inference_stream = torch.cuda.Stream() if self.device == "cuda" else None
+        # Page-locked staging buffers for model inputs
+        if self.device == "cuda":
+            self.pinned_pool = PinnedBufferPool(
+                pool_size=int(os.getenv("PINNED_POOL_SIZE", "2")),
+                buffer_bytes=int(os.getenv("PINNED_BUFFER_MB", "64")) * 1024 * 1024,
+            )
+        else:
+            self.pinned_pool = None
+        # Reduced precision for SAM and DepthPro forwards (bf16 where the GPU supports it)
+        if self.device == "cuda":
+            self.autocast_dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+        else:
+            self.autocast_dtype = None
+        # Mask PNG encoding runs in OpenCV with the GIL released, so masks encode in parallel
+        self._encode_pool = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix="mask-encode")
+        # Reused full-size canvases for the visualizations; concurrent requests each borrow their own set
+        self.viz_scratch = ScratchBufferPool(int(os.getenv("VIZ_SCRATCH_SETS", "2")))
+        self.viz_jpeg_quality = int(os.getenv("VIZ_JPEG_QUALITY", "85"))
         self.load_models()
+        self.compile_models()
+        self.warmup_models()
+        self.warmup_kernels()
     
     def load_models(self):
         """Load YOLOv8, SAM, and DepthPro models"""
         try:
+            if self.device == "cuda":
+                # Let remaining fp32 matmuls use TF32 tensor cores and autotune cuDNN conv algorithms
+                torch.set_float32_matmul_precision('high')
+                torch.backends.cudnn.benchmark = True
+                # Optional cap so several workers sharing one GPU (e.g. under MPS) can't starve each other
+                memory_fraction = os.getenv("CUDA_MEMORY_FRACTION")
+                if memory_fraction:
+                    torch.cuda.set_per_process_memory_fraction(float(memory_fraction))
+                    logger.info(f"CUDA memory fraction capped at {float(memory_fraction):.2f}")
+            
             # Load YOLOv8 model
             yolo_model_path = "yolov8_model/best (2).pt"
             if not os.path.exists(yolo_model_path):
                 raise FileNotFoundError(f"YOLOv8 model not found at {yolo_model_path}")
             
-            self.yolo_model = YOLO(yolo_model_path)
+            if self.use_trt:
+                yolo_model_path = self.export_yolo_engine(yolo_model_path)
+            
+            self.yolo_model = YOLO(yolo_model_path, task="detect")
+            self.wall_class_id = next((class_id for class_id, name in self.yolo_model.names.items() if name == 'wall'), None)
+            if self.wall_class_id is None:
+                raise ValueError(f"YOLOv8 model at {yolo_model_path} has no 'wall' class")
             logger.info(f"YOLOv8 model loaded from: {yolo_model_path}")
             
             # Load SAM model
@@ -52,49 +299,140 @@ class WallAnalysisService:
             # Load DepthPro model
             logger.info("Loading DepthPro model...")
             self.depth_processor = DepthProImageProcessorFast.from_pretrained("apple/DepthPro-hf")
-            self.depth_model = DepthProForDepthEstimation.from_pretrained("apple/DepthPro-hf").to(self.device)
+            if self.use_trt:
+                self.depth_model = self.load_depth_engine()
+            else:
+                self.depth_model = DepthProForDepthEstimation.from_pretrained("apple/DepthPro-hf").to(self.device)
             logger.info("DepthPro model loaded successfully!")
             
         except Exception as e:
             logger.error(f"Error loading models: {str(e)}")
             raise
     
+    def export_yolo_engine(self, yolo_model_path: str) -> str:
+        """Export the YOLOv8 weights to an FP16 TensorRT engine once and return its path"""
+        engine_name = os.path.splitext(os.path.basename(yolo_model_path))[0] + ".engine"
+        engine_path = os.path.join(self.trt_engine_dir, engine_name)
+        if not os.path.exists(engine_path):
+            logger.info("Exporting YOLOv8 to TensorRT (one-time)...")
+            # Dynamic batch up to the batcher's maximum so coalesced requests fit one engine call
+            exported_path = YOLO(yolo_model_path).export(
+                format="engine",
+                half=True,
+                dynamic=True,
+                batch=int(os.getenv("INFERENCE_BATCH_SIZE", "16")),
+                imgsz=640,
+                workspace=4,
+            )
+            # Ultralytics writes the engine next to the weights; keep it with the other engines
+            os.makedirs(self.trt_engine_dir, exist_ok=True)
+            shutil.move(exported_path, engine_path)
+        return engine_path
+    
+    def load_depth_engine(self):
+        """Build (once) and load the DepthPro TensorRT engine in place of the PyTorch model"""
+        from tensorrt_backend import TensorRTDepthModel, build_depth_engine
+        
+        engine_path = os.path.join(self.trt_engine_dir, "depth_pro_fp16.engine")
+        if not os.path.exists(engine_path):
+            # The PyTorch weights are only needed to build the engine, so a cached engine skips loading them
+            logger.info("Building DepthPro TensorRT engine (one-time)...")
+            depth_model = DepthProForDepthEstimation.from_pretrained("apple/DepthPro-hf").to(self.device)
+            size = self.depth_processor.size
+            build_depth_engine(depth_model, (1, 3, size["height"], size["width"]), engine_path)
+            del depth_model
+            torch.cuda.empty_cache()
+        
+        depth_engine = TensorRTDepthModel(engine_path, device=self.device)
+        logger.info(f"DepthPro TensorRT engine loaded from: {engine_path}")
+        return depth_engine
+    
+    def compile_models(self):
+        """Compile the static-shape model forwards with torch.compile"""
+        if self.device != "cuda" or os.getenv("TORCH_COMPILE", "1") == "0":
+            logger.info("Skipping torch.compile")
+            return
+        
+        # DepthPro's processor always resizes to 1536x1536 and SAM's encoder always sees a padded
+        # 1024x1024 image, so both compile once with static shapes. SAM's mask decoder is left eager
+        # since its batch dimension follows the number of boxes. Default mode rather than
+        # reduce-overhead: CUDA-graph outputs are overwritten on replay, and these models are
+        # called from several worker threads.
+        logger.info("Compiling DepthPro and SAM image encoder with torch.compile...")
+        if not self.use_trt:
+            self.depth_model = torch.compile(self.depth_model, dynamic=False)
+        self.sam_model.image_encoder = torch.compile(self.sam_model.image_encoder, dynamic=False)
+    
+    def warmup_models(self):
+        """Run a dummy forward through each model so the first request skips compile, autotune and allocator growth"""
+        if self.device != "cuda":
+            logger.info("Skipping model warmup on CPU")
+            return
+        
+        logger.info("Warming up YOLOv8, SAM and DepthPro...")
+        with self.stream_context(self.inference_stream):
+            self.detect_walls_batch([np.zeros((640, 640, 3), dtype=np.uint8)])
+            with torch.inference_mode(), self.autocast_context():
+                self.sam_predictor.set_image(np.zeros((1024, 1024, 3), dtype=np.uint8))
+            self.sam_predictor.reset_image()
+        if self.inference_stream is not None:
+            self.inference_stream.synchronize()
+        # DepthPro resizes every input to 1536x1536, so any image size exercises the real shapes
+        self.generate_depth_map(torch.zeros((3, 1024, 1024), dtype=torch.uint8))
+        logger.info("Model warmup completed")
+    
+    @staticmethod
+    def stream_context(stream):
+        """Run enclosed CUDA work on the given stream (no-op on CPU)"""
+        return torch.cuda.stream(stream) if stream is not None else nullcontext()
+    
+    def to_device(self, tensor: torch.Tensor) -> torch.Tensor:
+        """Move a host tensor to the model device, staging through pinned memory on CUDA"""
+        if self.pinned_pool is None:
+            return tensor.to(self.device)
+        return self.pinned_pool.to_device(tensor, self.device)
+    
+    def autocast_context(self):
+        """Mixed-precision context for model forwards (no-op on CPU)"""
+        if self.autocast_dtype is None:
+            return nullcontext()
+        return torch.autocast(device_type="cuda", dtype=self.autocast_dtype)
+    
+    def warmup_kernels(self):
+        """Compile the Numba kernels up front so the first request doesn't pay JIT cost"""
+        _depth_min_max_mean(np.zeros((2, 2), dtype=np.float32))
+        _wall_depth_stats(np.zeros((2, 2), dtype=np.float32), np.zeros((1, 2, 2), dtype=np.bool_), np.zeros(1, dtype=np.int64))
+        logger.info("Numba kernels compiled")
+    
+    @torch.inference_mode()
+    def depth_range(self, depth_map: torch.Tensor) -> tuple:
+        """Return (min, max, mean) of a depth map in one pass"""
+        if depth_map.is_cuda:
+            # Reduce on the device so only three scalars cross the bus
+            min_depth, max_depth = torch.aminmax(depth_map)
+            stats = torch.stack([min_depth, max_depth, depth_map.mean()]).cpu()
+            return float(stats[0]), float(stats[1]), float(stats[2])
+        min_depth, max_depth, mean_depth = _depth_min_max_mean(np.ascontiguousarray(depth_map.numpy(), dtype=np.float32))
+        return float(min_depth), float(max_depth), float(mean_depth)
+    
     def preprocess_image(self, image_bytes: bytes) -> tuple:
-        """Convert uploaded image bytes to OpenCV format and PIL format"""
+        """Decode uploaded image bytes into an RGB array and a CHW RGB tensor view for DepthPro"""
         try:
-            # Load with PIL for depth estimation and EXIF handling
+            # Load with PIL for EXIF handling
             pil_image = Image.open(BytesIO(image_bytes))
             
-            # Handle EXIF orientation
-            try:
-                from PIL.ExifTags import TAGS
-                exif = pil_image._getexif()
-                if exif is not None:
-                    orientation_key = None
-                    for key, value in TAGS.items():
-                        if value == 'Orientation':
-                            orientation_key = key
-                            break
-                    
-                    if orientation_key and orientation_key in exif:
-                        orientation = exif[orientation_key]
-                        if orientation == 3:
-                            pil_image = pil_image.rotate(180, expand=True)
-                        elif orientation == 6:
-                            pil_image = pil_image.rotate(270, expand=True)
-                        elif orientation == 8:
-                            pil_image = pil_image.rotate(90, expand=True)
-            except (AttributeError, KeyError, TypeError, ImportError):
-                pass
-         
+            # Handle EXIF orientation (all eight cases, including mirrored ones)
+            pil_image = ImageOps.exif_transpose(pil_image)
+            
             if pil_image.mode != 'RGB':
                 pil_image = pil_image.convert('RGB')
             
-            # Convert to numpy array and then to OpenCV format
-            image_array = np.array(pil_image)
-            image_bgr = cv2.cvtColor(image_array, cv2.COLOR_RGB2BGR)
+            # Keep the decoded pixels in RGB; only YOLO input and final encodes need BGR
+            image_rgb = np.array(pil_image)
+            # Zero-copy CHW view of the decoded RGB pixels, uploaded by generate_depth_map
+            image_tensor = torch.from_numpy(image_rgb).permute(2, 0, 1)
             
-            return image_bgr, pil_image
+            return image_rgb, image_tensor
             
         except Exception as e:
             logger.error(f"Error preprocessing image: {str(e)}")
@@ -102,78 +440,165 @@ class WallAnalysisService:
     
     def detect_walls(self, image: np.ndarray, confidence: float = 0.3) -> List[Dict[str, Any]]:
         """Detect walls using YOLOv8"""
+        return self.detect_walls_batch([image], confidence)[0]
+    
+    @torch.inference_mode()
+    def detect_walls_batch(self, images: List[np.ndarray], confidence: float = 0.3) -> List[List[Dict[str, Any]]]:
+        """Detect walls in several images with a single batched YOLOv8 forward pass"""
         try:
-            results = self.yolo_model.predict(image, conf=confidence, save=False, verbose=False)
+            # Ultralytics treats NumPy input as BGR, letterboxes each image and stacks them into one (B, 3, H, W) batch
+            images_bgr = [cv2.cvtColor(image, cv2.COLOR_RGB2BGR) for image in images]
+            # Restrict NMS to the wall class so other boxes never leave the model
+            results = self.yolo_model.predict(
+                images_bgr, conf=confidence, classes=[self.wall_class_id], save=False, verbose=False
+            )
             
-            wall_detections = []
+            batch_detections = []
             
-            if results[0].boxes is not None:
-                boxes = results[0].boxes.xyxy.cpu().numpy()
-                scores = results[0].boxes.conf.cpu().numpy()
-                classes = results[0].boxes.cls.cpu().numpy()
+            for result in results:
+                wall_detections = []
                 
-                for i in range(len(boxes)):
-                    class_id = int(classes[i])
-                    class_name = self.yolo_model.names[class_id]
+                if result.boxes is not None:
+                    keep = result.boxes.cls.cpu().numpy().astype(int) == self.wall_class_id
+                    boxes = result.boxes.xyxy.cpu().numpy()[keep]
+                    scores = result.boxes.conf.cpu().numpy()[keep]
                     
-                    if class_name == 'wall':
-                        wall_detections.append({
-                            'bbox': boxes[i].tolist(),
-                            'score': float(scores[i]),
-                            'class_id': class_id,
-                            'class_name': class_name
-                        })
+                    wall_detections = [
+                        {
+                            'bbox': box.tolist(),
+                            'score': float(score),
+                            'class_id': self.wall_class_id,
+                            'class_name': 'wall'
+                        }
+                        for box, score in zip(boxes, scores)
+                    ]
+                
+                batch_detections.append(wall_detections)
             
-            logger.info(f"Wall detections found: {len(wall_detections)}")
-            return wall_detections
+            logger.info(f"Wall detections found: {[len(d) for d in batch_detections]}")
+            return batch_detections
             
         except Exception as e:
             logger.error(f"Error in wall detection: {str(e)}")
             raise
     
-    def segment_walls(self, image: np.ndarray, wall_detections: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    def detect_and_segment_batch(self, images: List[np.ndarray], image_keys: List[str] = None) -> List[tuple]:
+        """Run YOLOv8 on a batch of images, then SAM on each image with detections; a failed image yields its exception"""
+        if image_keys is None:
+            image_keys = [None] * len(images)
+        
+        with self.stream_context(self.inference_stream):
+            batch_detections = self.detect_walls_batch(images)
+            
+            results = []
+            for image, image_key, wall_detections in zip(images, image_keys, batch_detections):
+                # SamPredictor holds a single image embedding, so segmentation stays per image
+                try:
+                    wall_segments = self.segment_walls(image, wall_detections, image_key) if wall_detections else []
+                except Exception as e:
+                    # A bad image only fails its own request, not the rest of the batch
+                    logger.error(f"Segmentation failed for one image in batch: {str(e)}")
+                    results.append(e)
+                    continue
+                results.append((wall_detections, wall_segments))
+        
+        if self.inference_stream is not None:
+            self.inference_stream.synchronize()
+        
+        return results
+    
+    @torch.inference_mode()
+    def set_sam_image(self, image: np.ndarray, image_key: str = None):
+        """Load an image embedding into the SAM predictor, reusing a cached one for known images"""
+        if image_key is not None:
+            cached = self._sam_cache.get(image_key)
+            if cached is not None:
+                self._sam_cache.move_to_end(image_key)
+                (
+                    self.sam_predictor.features,
+                    self.sam_predictor.original_size,
+                    self.sam_predictor.input_size,
+                    self.sam_predictor.is_image_set,
+                ) = cached
+                logger.info(f"SAM embedding cache hit for image {image_key}")
+                return
+        
+        with self.autocast_context():
+            self.sam_predictor.set_image(image)
+        
+        if image_key is not None and self.sam_cache_size > 0:
+            self._sam_cache[image_key] = (
+                self.sam_predictor.features,
+                self.sam_predictor.original_size,
+                self.sam_predictor.input_size,
+                self.sam_predictor.is_image_set,
+            )
+            while len(self._sam_cache) > self.sam_cache_size:
+                self._sam_cache.popitem(last=False)
+    
+    @torch.inference_mode()
+    def segment_walls(self, image: np.ndarray, wall_detections: List[Dict[str, Any]], image_key: str = None) -> List[Dict[str, Any]]:
         """Segment walls using SAM"""
         try:
-            image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-            self.sam_predictor.set_image(image_rgb)
-            
             wall_segments = []
+            if not wall_detections:
+                return wall_segments
             
-            for i, wall_det in enumerate(wall_detections):
-                logger.info(f"Processing wall {i+1}/{len(wall_detections)}")
-                
-                x1, y1, x2, y2 = wall_det['bbox']
-                input_box = np.array([[x1, y1, x2, y2]])
+            with self._sam_lock:
+                self.set_sam_image(image, image_key)
                 
-                masks, scores, logits = self.sam_predictor.predict(
-                    point_coords=None,
-                    point_labels=None,
-                    box=input_box[None, :],
-                    multimask_output=False,
+                # Decode every box prompt against the cached image embedding in one batched call
+                boxes = torch.as_tensor(
+                    np.array([wall_det['bbox'] for wall_det in wall_detections], dtype=np.float32),
+                    device=self.device,
                 )
+                transformed_boxes = self.sam_predictor.transform.apply_boxes_torch(boxes, image.shape[:2])
+                with self.autocast_context():
+                    masks, scores, logits = self.sam_predictor.predict_torch(
+                        point_coords=None,
+                        point_labels=None,
+                        boxes=transformed_boxes,
+                        multimask_output=False,
+                    )
+            # Device masks stay resident for the depth reduction; the host copy feeds OpenCV and PNG encoding
+            mask_tensors = masks[:, 0]
+            masks = mask_tensors.cpu().numpy()
+            scores = scores[:, 0].float().cpu().numpy()
+            
+            encode_futures = []
+            for i, wall_det in enumerate(wall_detections):
+                x1, y1, x2, y2 = wall_det['bbox']
                 
                 # Store mask as numpy array for further processing
-                mask_array = masks[0]
+                mask_array = masks[i]
                 
-                # Encode mask for response
+                # Encode mask for response off this thread; collected after the loop
                 mask_uint8 = (mask_array * 255).astype(np.uint8)
-                _, mask_encoded = cv2.imencode('.png', mask_uint8)
-                mask_base64 = base64.b64encode(mask_encoded).decode('utf-8')
+                encode_futures.append(self._encode_pool.submit(self.encode_mask_png, mask_uint8))
+                
+                # Cache the label anchor so the visualizations never rescan the mask
+                moments = cv2.moments(mask_uint8, binaryImage=True)
+                centroid = (moments['m10'] / moments['m00'], moments['m01'] / moments['m00']) if moments['m00'] > 0 else None
                 
                 wall_segments.append({
                     'wall_id': i + 1,
-                    'mask_array': mask_array,  # Keep for depth analysis
-                    'mask_base64': mask_base64,
-                    'sam_score': float(scores[0]),
+                    'mask_array': mask_array,  # Keep for visualization
+                    'mask_tensor': mask_tensors[i],  # Keep on device for depth analysis
+                    'mask_uint8': mask_uint8,  # 0/255 copy for OpenCV contour extraction
+                    'sam_score': float(scores[i]),
                     'yolo_score': wall_det['score'],
                     'bbox': wall_det['bbox'],
-                    'mask_area_pixels': int(np.sum(mask_array)),
+                    'mask_area_pixels': int(np.count_nonzero(mask_array)),
+                    'centroid': centroid,
                     'bbox_dimensions': {
                         'width': float(x2 - x1),
                         'height': float(y2 - y1)
                     }
                 })
             
+            for segment, future in zip(wall_segments, encode_futures):
+                segment['mask_png'] = future.result()
+            
             logger.info(f"Processed {len(wall_segments)} wall segments")
             return wall_segments
             
@@ -181,23 +606,38 @@ class WallAnalysisService:
             logger.error(f"Error in wall segmentation: {str(e)}")
             raise
     
-    def get_wall_corners(self, mask: np.ndarray) -> np.ndarray:
-        """Extract corner coordinates from wall mask"""
+    def encode_mask_png(self, mask_uint8: np.ndarray) -> bytes:
+        """Encode a binary mask as 1-bit PNG bytes (decode with cv2.imdecode)"""
+        _, mask_encoded = cv2.imencode('.png', mask_uint8, [cv2.IMWRITE_PNG_BILEVEL, 1, cv2.IMWRITE_PNG_COMPRESSION, 1])
+        return mask_encoded.tobytes()
+    
+    def encode_visualization(self, image_bgr: np.ndarray) -> str:
+        """Encode a full-color visualization as base64 JPEG (masks stay lossless PNG)"""
+        _, img_encoded = cv2.imencode('.jpg', image_bgr, [cv2.IMWRITE_JPEG_QUALITY, self.viz_jpeg_quality, cv2.IMWRITE_JPEG_OPTIMIZE, 0])
+        return base64.b64encode(img_encoded).decode('utf-8')
+    
+    def get_wall_corners(self, mask_uint8: np.ndarray) -> np.ndarray:
+        """Extract corner coordinates from a uint8 wall mask"""
         try:
-            contours, _ = cv2.findContours(mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            contours, _ = cv2.findContours(mask_uint8, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
             
             if not contours:
                 return np.array([])
             
             largest_contour = max(contours, key=cv2.contourArea)
-            epsilon = 0.02 * cv2.arcLength(largest_contour, True)
-            approx = cv2.approxPolyDP(largest_contour, epsilon, True)
+            perimeter = cv2.arcLength(largest_contour, True)
             
-            if len(approx) != 4:
-                x, y, w, h = cv2.boundingRect(largest_contour)
-                corners = np.array([[x, y], [x + w, y], [x + w, y + h], [x, y + h]])
-            else:
-                corners = approx.reshape(-1, 2)
+            # Try progressively coarser approximations until the outline reduces to a quad
+            corners = None
+            for epsilon_ratio in (0.01, 0.02, 0.04):
+                approx = cv2.approxPolyDP(largest_contour, epsilon_ratio * perimeter, True)
+                if len(approx) == 4:
+                    corners = approx.reshape(-1, 2)
+                    break
+            
+            if corners is None:
+                # Rotated rectangle keeps the wall's orientation, unlike an axis-aligned bounding box
+                corners = cv2.boxPoints(cv2.minAreaRect(largest_contour)).astype(np.float32)
             
             return self.sort_corners(corners)
             
@@ -211,63 +651,105 @@ class WallAnalysisService:
             return corners
             
         center = np.mean(corners, axis=0)
+        angles = np.arctan2(corners[:, 1] - center[1], corners[:, 0] - center[0])
+        sorted_corners = corners[np.argsort(angles, kind='stable')]
         
-        def angle_from_center(point):
-            return np.arctan2(point[1] - center[1], point[0] - center[0])
-        
-        sorted_corners = sorted(corners, key=angle_from_center)
-        min_sum_idx = np.argmin([p[0] + p[1] for p in sorted_corners])
-        ordered_corners = sorted_corners[min_sum_idx:] + sorted_corners[:min_sum_idx]
-        
-        return np.array(ordered_corners)
+        # Rotate so the top-left (smallest x + y) corner comes first
+        min_sum_idx = int(np.argmin(sorted_corners.sum(axis=1)))
+        return np.roll(sorted_corners, -min_sum_idx, axis=0)
     
-    def generate_depth_map(self, pil_image: Image.Image) -> np.ndarray:
-        """Generate depth map using DepthPro"""
+    @torch.inference_mode()
+    def generate_depth_map(self, image_tensor: torch.Tensor) -> torch.Tensor:
+        """Generate a float32 depth map on the model device using DepthPro from a CHW uint8 RGB tensor"""
         try:
-            logger.info(f"Generating depth map for image size: {pil_image.size}")
-            
-            # Preprocess image
-            logger.info("Preprocessing image for depth estimation...")
-            inputs = self.depth_processor(images=pil_image, return_tensors="pt").to(self.depth_model.device)
-            logger.info(f"Input tensor shape: {inputs['pixel_values'].shape}")
-            
-            # Inference
-            logger.info("Running depth inference...")
-            with torch.no_grad():
-                outputs = self.depth_model(**inputs)
+            height, width = image_tensor.shape[-2:]
+            logger.info(f"Generating depth map for image size: {(width, height)}")
             
-            logger.info("Post-processing depth results...")
-            # Post-process to match original resolution
-            depth = self.depth_processor.post_process_depth_estimation(
-                outputs, target_sizes=[(pil_image.height, pil_image.width)]
-            )[0]
+            with self.stream_context(self.depth_stream):
+                # Upload the raw uint8 pixels and resize/normalize on the device
+                logger.info("Preprocessing image for depth estimation...")
+                device_image = self.to_device(image_tensor)
+                inputs = self.depth_processor(images=device_image, return_tensors="pt", device=self.device)
+                logger.info(f"Input tensor shape: {inputs['pixel_values'].shape}")
+                
+                # Inference
+                logger.info("Running depth inference...")
+                with self._depth_model_lock, self.autocast_context():
+                    outputs = self.depth_model(**inputs)
+                
+                # Post-process in full precision so the focal-length rescale doesn't lose depth resolution
+                outputs.predicted_depth = outputs.predicted_depth.float()
+                if outputs.field_of_view is not None:
+                    outputs.field_of_view = outputs.field_of_view.float()
+                
+                logger.info("Post-processing depth results...")
+                # Post-process to match original resolution
+                depth = self.depth_processor.post_process_depth_estimation(
+                    outputs, target_sizes=[(height, width)]
+                )[0]
+                
+                # Stays on the device; analysis reduces it there and reads back only per-wall stats
+                depth_map = depth['predicted_depth'].squeeze()
             
-            depth_map = depth['predicted_depth'].squeeze().cpu().numpy()
+            # Consumers run on other streams, so the map must be complete before it is handed out
+            if self.depth_stream is not None:
+                self.depth_stream.synchronize()
             
             logger.info(f"Depth map generated successfully!")
             logger.info(f"Depth map shape: {depth_map.shape}")
-            logger.info(f"Depth range: {np.min(depth_map):.3f}m to {np.max(depth_map):.3f}m")
-            logger.info(f"Mean depth: {np.mean(depth_map):.3f}m")
             
             return depth_map
             
         except Exception as e:
-            logger.error(f"Error generating depth map: {str(e)}")
-            logger.error(f"Error type: {type(e).__name__}")
-            import traceback
-            logger.error(f"Traceback: {traceback.format_exc()}")
+            logger.exception(f"Error generating depth map: {type(e).__name__}: {str(e)}")
             raise
     
+    @staticmethod
+    def content_hash(data: bytes) -> str:
+        """Fast content hash used as a cache key for uploaded images"""
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+    
+    def get_cached_depth_map(self, key: str):
+        """Return the cached depth map for an image hash on the model device, or None on a miss"""
+        with self._depth_cache_lock:
+            cached = self._depth_cache.get(key)
+            if cached is None:
+                return None
+            self._depth_cache.move_to_end(key)
+        # Upload at half width and widen on the device
+        return self.to_device(torch.from_numpy(cached)).float()
+    
+    def cache_depth_map(self, key: str, depth_map: torch.Tensor):
+        """Store a depth map (as float16 to halve host memory), evicting least recently used entries"""
+        if self.depth_cache_size <= 0:
+            return
+        host_depth = depth_map.to(torch.float16).cpu().numpy()
+        with self._depth_cache_lock:
+            self._depth_cache[key] = host_depth
+            self._depth_cache.move_to_end(key)
+            while len(self._depth_cache) > self.depth_cache_size:
+                self._depth_cache.popitem(last=False)
+    
+    def get_or_generate_depth_map(self, key: str, image_tensor: torch.Tensor) -> tuple:
+        """Return (depth_map, cache_hit), running DepthPro only on a cache miss"""
+        depth_map = self.get_cached_depth_map(key)
+        if depth_map is not None:
+            logger.info(f"Depth map cache hit for image {key}")
+            return depth_map, True
+        
+        depth_map = self.generate_depth_map(image_tensor)
+        # The host copy for the cache happens off the request path, which only needs the device map
+        if self.depth_cache_size > 0:
+            self._encode_pool.submit(self.cache_depth_map, key, depth_map)
+        return depth_map, False
+    
     def calculate_pixel_to_meter_scale(self, depth_value: float, focal_length: float) -> float:
         """Calculate the scale factor to convert pixels to meters at a given depth"""
         return depth_value / focal_length
     
-    def calculate_wall_area_in_meters(self, mask: np.ndarray, wall_depths: np.ndarray, focal_length: float) -> float:
-        """Calculate wall area in square meters using depth information"""
+    def calculate_wall_area_in_meters(self, area_pixels: int, representative_depth: float, focal_length: float) -> float:
+        """Calculate wall area in square meters from the mask pixel count and its median depth"""
         try:
-            # Use the median depth for more stable calculation
-            representative_depth = np.median(wall_depths)
-            
             # Calculate the scale at this depth
             scale = self.calculate_pixel_to_meter_scale(representative_depth, focal_length)
             
@@ -275,7 +757,7 @@ class WallAnalysisService:
             pixel_area_m2 = scale ** 2
             
             # Total area is number of pixels * area per pixel
-            total_area = np.sum(mask) * pixel_area_m2
+            total_area = area_pixels * pixel_area_m2
             
             return total_area
             
@@ -330,7 +812,47 @@ class WallAnalysisService:
             logger.error(f"Error calculating wall dimensions: {str(e)}")
             return None
     
-    def analyze_wall_depths(self, wall_segments: List[Dict[str, Any]], depth_map: np.ndarray, image_shape: tuple) -> List[Dict[str, Any]]:
+    @torch.inference_mode()
+    def resize_masks(self, masks_t: torch.Tensor, shape: tuple) -> torch.Tensor:
+        """Resize stacked (N, H, W) boolean masks to shape in one interpolate call, if needed"""
+        if masks_t.shape[1:] == tuple(shape):
+            return masks_t
+        if shape[0] <= masks_t.shape[1] and shape[1] <= masks_t.shape[2]:
+            # Downsampling: area-average coverage and keep pixels more than half covered, avoiding aliased edges
+            coverage_dtype = torch.float16 if masks_t.is_cuda else torch.float32
+            coverage = F.interpolate(masks_t.unsqueeze(1).to(coverage_dtype), size=tuple(shape), mode='area')
+            return coverage.squeeze(1) > 0.5
+        resized = F.interpolate(masks_t.unsqueeze(1).to(torch.uint8), size=tuple(shape), mode='nearest')
+        return resized.squeeze(1).bool()
+    
+    @torch.inference_mode()
+    def wall_depth_stats_gpu(self, depth_map: torch.Tensor, masks_t: torch.Tensor) -> tuple:
+        """Per-wall count, sum, sum of squares, min, max and median of depth, reduced on the device"""
+        # Per-wall masks rather than a label map, since SAM masks can overlap. Nothing in the loop
+        # reads a value back, so every wall is queued before the single copy of the (N, 6) stats.
+        depth = depth_map.reshape(-1).float()
+        depth64 = depth.double()
+        flat_masks = masks_t.reshape(masks_t.shape[0], -1)
+        stats = torch.zeros((flat_masks.shape[0], 6), dtype=torch.float64, device=depth.device)
+        for k, mask in enumerate(flat_masks):
+            count = mask.sum()
+            masked = torch.where(mask, depth64, 0.0)
+            # Pixels outside the wall sort to the end, so min, max and the two middle order
+            # statistics (averaged to match np.median on even counts) are gathered by position
+            ordered = torch.where(mask, depth, torch.inf).sort().values
+            last = (count - 1).clamp(min=0)
+            positions = torch.stack([torch.zeros_like(last), last, last // 2, count // 2])
+            picked = ordered.index_select(0, positions).double()
+            stats[k, 0] = count
+            stats[k, 1] = masked.sum()
+            stats[k, 2] = masked.square().sum()
+            stats[k, 3] = picked[0]
+            stats[k, 4] = picked[1]
+            stats[k, 5] = (picked[2] + picked[3]) / 2
+        stats = stats.cpu().numpy()
+        return stats[:, 0].astype(np.int64), stats[:, 1], stats[:, 2], stats[:, 3], stats[:, 4], stats[:, 5]
+    
+    def analyze_wall_depths(self, wall_segments: List[Dict[str, Any]], depth_map: torch.Tensor, image_shape: tuple) -> List[Dict[str, Any]]:
         """Analyze depth values within wall regions and calculate measurements"""
         try:
             logger.info("Analyzing wall depths...")
@@ -342,49 +864,63 @@ class WallAnalysisService:
             focal_length = max(width, height) * 0.8
             logger.info(f"Estimated focal length: {focal_length:.1f} pixels")
             
-            for segment in wall_segments:
+            if not wall_segments:
+                return wall_depth_analysis
+            
+            # Get corner coordinates
+            wall_corners = [self.get_wall_corners(segment['mask_uint8']) for segment in wall_segments]
+            
+            # Resize masks to match depth map if necessary; both stay wherever SAM and DepthPro produced them
+            masks_t = self.resize_masks(torch.stack([segment['mask_tensor'] for segment in wall_segments]), depth_map.shape)
+            
+            if depth_map.is_cuda:
+                # Only the (N, 6) stat vector comes back to host
+                counts, sums, sums_sq, mins, maxs, medians = self.wall_depth_stats_gpu(depth_map, masks_t)
+            else:
+                # Fused per-wall reduction: sum/sum²/min/max/median in one pass per mask
+                depth_values = np.ascontiguousarray(depth_map.numpy(), dtype=np.float32)
+                stacked_masks = masks_t.numpy()
+                counts = np.count_nonzero(stacked_masks, axis=(1, 2)).astype(np.int64)
+                sums, sums_sq, mins, maxs, medians = _wall_depth_stats(depth_values, stacked_masks, counts)
+            safe_counts = np.maximum(counts, 1)
+            means = sums / safe_counts
+            stds = np.sqrt(np.maximum(sums_sq / safe_counts - means ** 2, 0.0))
+            
+            for idx, segment in enumerate(wall_segments):
                 wall_id = segment['wall_id']
-                mask = segment['mask_array']
+                corners = wall_corners[idx]
+                area_pixels = int(counts[idx])
                 
-                # Get corner coordinates
-                corners = self.get_wall_corners(mask)
-                
-                # Resize mask to match depth map if necessary
-                if mask.shape != depth_map.shape:
-                    resized_mask = cv2.resize(mask.astype(np.uint8), (depth_map.shape[1], depth_map.shape[0]), interpolation=cv2.INTER_NEAREST)
-                    resized_mask = resized_mask.astype(bool)
-                else:
-                    resized_mask = mask.astype(bool)
-                
-                # Get depth values within the wall mask
-                wall_depths = depth_map[resized_mask]
-                
-                if len(wall_depths) > 0 and len(corners) > 0:
+                if area_pixels > 0 and len(corners) > 0:
+                    mean_depth = float(means[idx])
+                    median_depth = float(medians[idx])
+                    
                     # Calculate area in square meters
-                    area_m2 = self.calculate_wall_area_in_meters(resized_mask, wall_depths, focal_length)
+                    area_m2 = self.calculate_wall_area_in_meters(area_pixels, median_depth, focal_length)
                     
                     # Calculate wall dimensions (length and width)
-                    dimensions = self.calculate_wall_dimensions(corners, np.mean(wall_depths), focal_length)
+                    dimensions = self.calculate_wall_dimensions(corners, mean_depth, focal_length)
                     
                     analysis = {
                         'wall_id': wall_id,
                         'corners': corners.tolist() if len(corners) > 0 else [],
-                        'min_depth': float(np.min(wall_depths)),
-                        'max_depth': float(np.max(wall_depths)),
-                        'mean_depth': float(np.mean(wall_depths)),
-                        'median_depth': float(np.median(wall_depths)),
-                        'std_depth': float(np.std(wall_depths)),
-                        'area_pixels': int(np.sum(resized_mask)),
+                        'min_depth': float(mins[idx]),
+                        'max_depth': float(maxs[idx]),
+                        'mean_depth': mean_depth,
+                        'median_depth': median_depth,
+                        'std_depth': float(stds[idx]),
+                        'area_pixels': area_pixels,
                         'area_square_meters': float(area_m2),
                         'dimensions': dimensions,
                         'yolo_score': segment['yolo_score'],
                         'sam_score': segment['sam_score'],
-                        'mask_base64': segment['mask_base64']  # Keep for visualization
+                        'mask_array': segment['mask_array'],  # Keep for visualization
+                        'mask_png': segment['mask_png']
                     }
                     
                     wall_depth_analysis.append(analysis)
                     
-                    logger.info(f"Wall {wall_id}: Area={area_m2:.2f}m², Mean depth={np.mean(wall_depths):.2f}m")
+                    logger.info(f"Wall {wall_id}: Area={area_m2:.2f}m², Mean depth={mean_depth:.2f}m")
                     if dimensions:
                         logger.info(f"  Dimensions: {dimensions['length_meters']:.2f}m x {dimensions['width_meters']:.2f}m")
             
@@ -394,33 +930,41 @@ class WallAnalysisService:
             logger.error(f"Error analyzing wall depths: {str(e)}")
             raise
     
+    def union_mask(self, masks: List[np.ndarray], shape: tuple, out: np.ndarray = None) -> np.ndarray:
+        """OR a list of boolean masks into one mask of the given shape"""
+        if out is None:
+            union = np.zeros(shape, dtype=bool)
+        else:
+            union = out
+            union.fill(False)
+        for mask in masks:
+            np.logical_or(union, mask, out=union)
+        return union
+    
     def create_visualization(self, image: np.ndarray, wall_segments: List[Dict[str, Any]]) -> str:
         """Create visualization with dark green segmentation overlay"""
+        scratch = self.viz_scratch.acquire()
         try:
-            image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-            overlay = image_rgb.copy()
+            overlay = self.viz_scratch.array(scratch, 'canvas', image.shape)
+            np.copyto(overlay, image)
             
             # Use dark green color for all segments
             dark_green = (0, 100, 0)  # Dark green color
+            tint = self.viz_scratch.array(scratch, 'tint', image.shape)
+            tint[...] = dark_green
+            
+            # Apply dark green overlay to segmented areas only, as one blend over the union of masks
+            union = self.union_mask(
+                [segment['mask_array'] for segment in wall_segments], image.shape[:2],
+                out=self.viz_scratch.array(scratch, 'union', image.shape[:2], bool),
+            )
+            blended = cv2.addWeighted(overlay, 0.5, tint, 0.5, 0, dst=self.viz_scratch.array(scratch, 'blended', image.shape))
+            np.copyto(overlay, blended, where=union[..., None])
             
             for i, segment in enumerate(wall_segments):
-                # Get mask from mask_array if available, otherwise decode from base64
-                if 'mask_array' in segment:
-                    mask = segment['mask_array'] > 0
-                else:
-                    # Decode mask from base64
-                    mask_bytes = base64.b64decode(segment['mask_base64'])
-                    mask_array = np.frombuffer(mask_bytes, dtype=np.uint8)
-                    mask = cv2.imdecode(mask_array, cv2.IMREAD_GRAYSCALE)
-                    mask = mask > 0  # Convert to boolean mask
-                
-                # Apply dark green overlay to segmented areas only
-                overlay[mask] = overlay[mask] * 0.5 + np.array(dark_green) * 0.5
-                
                 # Add wall label at center of mask with better visibility
-                mask_coords = np.where(mask)
-                if len(mask_coords[0]) > 0:
-                    center_y, center_x = np.mean(mask_coords[0]), np.mean(mask_coords[1])
+                if segment['centroid'] is not None:
+                    center_x, center_y = segment['centroid']
                     
                     # Add black outline for better text visibility
                     text = f"Wall {i+1}"
@@ -429,7 +973,7 @@ class WallAnalysisService:
                     thickness = 3
                     
                     # Calculate text size for better positioning
-                    (text_width, text_height), _ = cv2.getTextSize(text, font, font_scale, thickness)
+                    text_width, text_height = _label_size(text, font_scale, thickness)
                     text_x = int(center_x - text_width // 2)
                     text_y = int(center_y + text_height // 2)
                     
@@ -439,40 +983,37 @@ class WallAnalysisService:
                     cv2.putText(overlay, text, (text_x, text_y), font, font_scale, (255, 255, 255), thickness)
             
             # Encode result
-            _, img_encoded = cv2.imencode('.png', cv2.cvtColor(overlay, cv2.COLOR_RGB2BGR))
-            img_base64 = base64.b64encode(img_encoded).decode('utf-8')
-            
-            return img_base64
+            overlay_bgr = cv2.cvtColor(overlay, cv2.COLOR_RGB2BGR, dst=self.viz_scratch.array(scratch, 'bgr', image.shape))
+            return self.encode_visualization(overlay_bgr)
             
         except Exception as e:
             logger.error(f"Error creating visualization: {str(e)}")
             raise
+        finally:
+            self.viz_scratch.release(scratch)
 
     def create_measurement_visualization(self, image: np.ndarray, wall_depth_analysis: List[Dict[str, Any]]) -> str:
         """Create visualization with segmented overlay and measurements"""
+        scratch = self.viz_scratch.acquire()
         try:
             logger.info("Creating measurement visualization...")
             
-            measurement_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB).copy()
-            overlay = measurement_image.copy()
+            measurement_image = self.viz_scratch.array(scratch, 'canvas', image.shape)
+            np.copyto(measurement_image, image)
             
             # Very dark green for segmentation
             dark_green = (0, 40, 0)  # Much darker green
+            tint = self.viz_scratch.array(scratch, 'tint', image.shape)
+            tint[...] = dark_green
             
-            # First, apply dark green segmentation for all walls
-            for analysis in wall_depth_analysis:
-                # Get or decode the mask
-                if 'mask_base64' in analysis:
-                    mask_bytes = base64.b64decode(analysis['mask_base64'])
-                    mask_array = np.frombuffer(mask_bytes, dtype=np.uint8)
-                    mask = cv2.imdecode(mask_array, cv2.IMREAD_GRAYSCALE)
-                    mask = mask > 0
-                    
-                    # Apply dark green overlay with stronger opacity
-                    overlay[mask] = overlay[mask] * 0.3 + np.array(dark_green) * 0.7
-            
-            # Blend the overlay with the original image with more overlay weight
-            measurement_image = cv2.addWeighted(measurement_image, 0.4, overlay, 0.6, 0)
+            # First, apply dark green segmentation for all walls. A 0.3/0.7 green overlay then
+            # blended 0.4/0.6 with the original collapses to one 0.58/0.42 blend inside the masks.
+            union = self.union_mask(
+                [analysis['mask_array'] for analysis in wall_depth_analysis], image.shape[:2],
+                out=self.viz_scratch.array(scratch, 'union', image.shape[:2], bool),
+            )
+            blended = cv2.addWeighted(measurement_image, 0.58, tint, 0.42, 0, dst=self.viz_scratch.array(scratch, 'blended', image.shape))
+            np.copyto(measurement_image, blended, where=union[..., None])
             
             # Now add measurements for each wall
             for idx, analysis in enumerate(wall_depth_analysis):
@@ -514,7 +1055,7 @@ class WallAnalysisService:
                 
                 # Width label (on horizontal line)
                 width_text = f"Width = {dimensions['width_meters']:.2f} m"
-                (w_width, w_height), _ = cv2.getTextSize(width_text, font, font_scale, font_thickness)
+                w_width, w_height = _label_size(width_text, font_scale, font_thickness)
                 
                 # Position width text above the horizontal line with even more spacing
                 width_x = cx - w_width // 2
@@ -535,7 +1076,7 @@ class WallAnalysisService:
                 
                 # Height label (on vertical line) - positioned to the right side
                 height_text = f"Height = {dimensions['length_meters']:.2f} m"
-                (h_width, h_height), _ = cv2.getTextSize(height_text, font, font_scale, font_thickness)
+                h_width, h_height = _label_size(height_text, font_scale, font_thickness)
                 
                 # Position height text to the right of vertical line with much more spacing
                 height_x = cx + 100  # Much more spacing for larger text
@@ -555,7 +1096,7 @@ class WallAnalysisService:
                 
                 # Add area in top right corner of the wall
                 area_text = f"Area = {area:.2f} m^2"  # Changed to m^2 instead of m²
-                (a_width, a_height), _ = cv2.getTextSize(area_text, font, 2.2, 5)  # Much larger font size
+                a_width, a_height = _label_size(area_text, 2.2, 5)  # Much larger font size
                 
                 # Position in top-right of wall bounding box
                 area_x = max_x - a_width - 20
@@ -575,7 +1116,7 @@ class WallAnalysisService:
                 
                 # Add wall ID label
                 wall_text = f"Wall {wall_id}"
-                (wt_width, wt_height), _ = cv2.getTextSize(wall_text, font, 1.2, 3)  # Increased font size
+                wt_width, wt_height = _label_size(wall_text, 1.2, 3)  # Increased font size
                 wall_label_x = min_x + 10
                 wall_label_y = min_y + wt_height + 10
                 
@@ -588,11 +1129,211 @@ class WallAnalysisService:
                           font, 1.2, (255, 255, 255), 3, cv2.LINE_AA)  # Increased font size and thickness
             
             # Encode result
-            _, img_encoded = cv2.imencode('.png', cv2.cvtColor(measurement_image, cv2.COLOR_RGB2BGR))
-            img_base64 = base64.b64encode(img_encoded).decode('utf-8')
-            
-            return img_base64
+            measurement_bgr = cv2.cvtColor(measurement_image, cv2.COLOR_RGB2BGR, dst=self.viz_scratch.array(scratch, 'bgr', image.shape))
+            return self.encode_visualization(measurement_bgr)
             
         except Exception as e:
             logger.error(f"Error creating measurement visualization: {str(e)}")
-            raise
\ No newline at end of file
+            raise
+        finally:
+            self.viz_scratch.release(scratch)
+
+
+class InferenceBatcher:
+    """Coalesce concurrent detect + segment requests into batched GPU passes"""
+    
+    def __init__(self, service: WallAnalysisService, max_batch_size: int = 16, max_wait_ms: float = 10.0):
+        self.service = service
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = None
+        self._task = None
+    
+    def start(self):
+        """Start the background batching task on the running event loop"""
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"Inference batcher started (batch size: {self.max_batch_size}, wait: {self.max_wait * 1000:.0f}ms)")
+    
+    async def stop(self):
+        """Cancel the background batching task"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    async def submit(self, image: np.ndarray, image_key: str = None) -> tuple:
+        """Queue an image (with its content hash for embedding reuse) and wait for its (wall_detections, wall_segments)"""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((image, image_key, future))
+        return await future
+    
+    async def _collect_batch(self) -> list:
+        """Wait for one request, then gather more until the batch is full or the window closes"""
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+        
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        
+        return batch
+    
+    async def _run(self):
+        while True:
+            batch = await self._collect_batch()
+            images = [image for image, _, _ in batch]
+            image_keys = [image_key for _, image_key, _ in batch]
+            logger.info(f"Running batched inference on {len(images)} image(s)")
+            
+            try:
+                # Blocking GPU work runs off the event loop on a single worker thread
+                results = await asyncio.to_thread(self.service.detect_and_segment_batch, images, image_keys)
+            except Exception as e:
+                logger.error(f"Batched inference failed: {str(e)}")
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            
+            for (_, _, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+
+
+class BlobStore:
+    """Store for large binary payloads served by URL instead of inlined in JSON.
+
+    Blobs live in process memory by default, capped at max_bytes with least recently used
+    eviction. With a directory they are written to disk so every uvicorn worker sharing that
+    directory can serve them. Disk mode does blocking file I/O, so call it off the event loop.
+    """
+    
+    BLOB_ID_PATTERN = re.compile(r"^[0-9a-f]{32}\.[a-z0-9]+$")
+    
+    def __init__(self, ttl_seconds: float = 300.0, directory: str = None, max_bytes: int = 256 * 1024 * 1024):
+        self.ttl_seconds = ttl_seconds
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._blobs = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self._last_file_purge = 0.0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+    
+    def put(self, data: bytes, media_type: str) -> str:
+        """Store a payload and return its id; it expires ttl_seconds after its last access"""
+        # The extension carries the media type, so disk-backed blobs need no metadata file
+        blob_id = uuid.uuid4().hex + (mimetypes.guess_extension(media_type) or ".bin")
+        if self.directory:
+            self._purge_expired_files()
+            path = os.path.join(self.directory, blob_id)
+            with open(path + ".tmp", "wb") as blob_file:
+                blob_file.write(data)
+            os.replace(path + ".tmp", path)
+            return blob_id
+        
+        now = time.monotonic()
+        with self._lock:
+            self._purge_expired(now)
+            self._blobs[blob_id] = (now + self.ttl_seconds, data, media_type)
+            self._total_bytes += len(data)
+            # Evict least recently used blobs once over the byte cap (the newest one always stays)
+            while self._total_bytes > self.max_bytes and len(self._blobs) > 1:
+                self._evict_oldest()
+        return blob_id
+    
+    def put_many(self, payloads: List[bytes], media_type: str) -> List[str]:
+        """Store several payloads of one media type and return their ids in order"""
+        return [self.put(data, media_type) for data in payloads]
+    
+    def get(self, blob_id: str):
+        """Return (data, media_type) for a live blob, or None"""
+        if self.directory:
+            if not self.BLOB_ID_PATTERN.match(blob_id):
+                return None
+            path = os.path.join(self.directory, blob_id)
+            try:
+                if os.path.getmtime(path) + self.ttl_seconds <= time.time():
+                    return None
+                with open(path, "rb") as blob_file:
+                    data = blob_file.read()
+                # Expiry is mtime-based, so touching the file slides the TTL like the in-memory store
+                os.utime(path)
+            except FileNotFoundError:
+                return None
+            return data, mimetypes.guess_type(blob_id)[0] or "application/octet-stream"
+        
+        now = time.monotonic()
+        with self._lock:
+            entry = self._blobs.get(blob_id)
+            if entry is None or entry[0] <= now:
+                return None
+            # Refresh the expiry and LRU position together, so order stays expiry order
+            self._blobs[blob_id] = (now + self.ttl_seconds, entry[1], entry[2])
+            self._blobs.move_to_end(blob_id)
+        return entry[1], entry[2]
+    
+    def _evict_oldest(self):
+        _, (_, data, _) = self._blobs.popitem(last=False)
+        self._total_bytes -= len(data)
+    
+    def _purge_expired(self, now: float):
+        # Every blob shares the same TTL and access moves it to the end, so order is expiry order
+        while self._blobs:
+            oldest_id = next(iter(self._blobs))
+            if self._blobs[oldest_id][0] > now:
+                break
+            self._evict_oldest()
+    
+    def _purge_expired_files(self):
+        # Scanning the directory on every put is wasteful; sweep at most every few seconds
+        now = time.time()
+        with self._lock:
+            if now - self._last_file_purge < min(self.ttl_seconds, 30.0):
+                return
+            self._last_file_purge = now
+        
+        cutoff = now - self.ttl_seconds
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.is_file() and entry.stat().st_mtime <= cutoff:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                # Another worker purged it first
+                pass
+
+
+_service_instance = None
+_service_pid = None
+_service_lock = threading.Lock()
+
+
+def get_wall_analysis_service() -> WallAnalysisService:
+    """Return this process's WallAnalysisService, loading the models on first use.
+
+    Idempotent per process: repeated calls (or a second import of the app module) reuse the same
+    instance, and a forked worker never reuses its parent's CUDA state.
+    """
+    global _service_instance, _service_pid
+    with _service_lock:
+        if _service_instance is None or _service_pid != os.getpid():
+            _service_instance = WallAnalysisService()
+            _service_pid = os.getpid()
+        return _service_instance
@@ -0,0 +1,92 @@
+from pydantic import BaseModel
+from typing import List, Optional, Dict, Any
+
+
+class DepthStats(BaseModel):
+    min_depth: float
+    max_depth: float
+    mean_depth: float
+    median_depth: float
+    std_depth: float
+
+
+class WallDimensions(BaseModel):
+    length_meters: float
+    width_meters: float
+    length_pixels: float
+    width_pixels: float
+    all_sides_pixels: List[float]
+    scale_factor: float
+
+
+class Measurements(BaseModel):
+    area_square_meters: float
+    area_pixels: int
+    dimensions: Optional[WallDimensions] = None
+
+
+class Scores(BaseModel):
+    yolo_score: float
+    sam_score: float
+
+
+class WallOut(BaseModel):
+    wall_id: int
+    corners: List[List[float]]
+    depth_stats: DepthStats
+    measurements: Measurements
+    scores: Scores
+    mask_url: str
+
+    @classmethod
+    def from_analysis(cls, analysis: Dict[str, Any], mask_url: str) -> "WallOut":
+        """Build the nested response shape from a flat analyze_wall_depths entry"""
+        return cls(
+            wall_id=analysis['wall_id'],
+            corners=analysis['corners'],
+            depth_stats=DepthStats(
+                min_depth=analysis['min_depth'],
+                max_depth=analysis['max_depth'],
+                mean_depth=analysis['mean_depth'],
+                median_depth=analysis['median_depth'],
+                std_depth=analysis['std_depth'],
+            ),
+            measurements=Measurements(
+                area_square_meters=analysis['area_square_meters'],
+                area_pixels=analysis['area_pixels'],
+                dimensions=analysis['dimensions'],
+            ),
+            scores=Scores(yolo_score=analysis['yolo_score'], sam_score=analysis['sam_score']),
+            mask_url=mask_url,
+        )
+
+
+class DepthRange(BaseModel):
+    min: float
+    max: float
+    mean: float
+
+
+class ImageDimensions(BaseModel):
+    width: int
+    height: int
+
+
+class AnalyzeSummary(BaseModel):
+    total_wall_area_square_meters: float
+    average_yolo_confidence: float
+    average_sam_score: float
+    depth_range: DepthRange
+    image_dimensions: ImageDimensions
+
+
+class AnalyzeResponse(BaseModel):
+    success: bool
+    message: str
+    wall_count: int
+    walls: List[WallOut] = []
+    segmentation_visualization: Optional[str] = None
+    measurement_visualization: Optional[str] = None
+    cache_hit: Optional[bool] = None
+    summary: Optional[AnalyzeSummary] = None
+    error_details: Optional[str] = None
@@ -0,0 +1,113 @@
+import os
+import threading
+import logging
+import torch
+import tensorrt as trt
+from transformers.models.depth_pro.modeling_depth_pro import DepthProDepthEstimatorOutput
+
+
+logger = logging.getLogger(__name__)
+
+TRT_LOGGER = trt.Logger(trt.Logger.WARNING)
+
+TRT_TO_TORCH_DTYPE = {
+    trt.float32: torch.float32,
+    trt.float16: torch.float16,
+    trt.int32: torch.int32,
+}
+
+
+class _DepthProExportWrapper(torch.nn.Module):
+    """Expose DepthPro's forward as plain tensors for ONNX export"""
+    
+    def __init__(self, model: torch.nn.Module):
+        super().__init__()
+        self.model = model
+    
+    def forward(self, pixel_values: torch.Tensor):
+        outputs = self.model(pixel_values=pixel_values)
+        return outputs.predicted_depth, outputs.field_of_view
+
+
+def build_depth_engine(depth_model: torch.nn.Module, input_shape: tuple, engine_path: str, workspace_gb: int = 4):
+    """Export DepthPro to ONNX (opset 17) and build an FP16 TensorRT engine from it"""
+    onnx_path = os.path.splitext(engine_path)[0] + ".onnx"
+    os.makedirs(os.path.dirname(engine_path) or ".", exist_ok=True)
+    
+    logger.info(f"Exporting DepthPro to ONNX at {onnx_path}...")
+    device = next(depth_model.parameters()).device
+    dummy_input = torch.zeros(input_shape, dtype=torch.float32, device=device)
+    with torch.no_grad():
+        torch.onnx.export(
+            _DepthProExportWrapper(depth_model).eval(),
+            (dummy_input,),
+            onnx_path,
+            opset_version=17,
+            input_names=["pixel_values"],
+            output_names=["predicted_depth", "field_of_view"],
+        )
+    
+    logger.info("Building DepthPro TensorRT engine (FP16)...")
+    builder = trt.Builder(TRT_LOGGER)
+    network = builder.create_network(0)
+    parser = trt.OnnxParser(network, TRT_LOGGER)
+    # parse_from_file resolves the external weight files written for models over 2GB
+    if not parser.parse_from_file(onnx_path):
+        errors = [str(parser.get_error(i)) for i in range(parser.num_errors)]
+        raise RuntimeError(f"Failed to parse DepthPro ONNX model: {errors}")
+    
+    config = builder.create_builder_config()
+    config.set_memory_pool_limit(trt.MemoryPoolType.WORKSPACE, workspace_gb * (1 << 30))
+    config.set_flag(trt.BuilderFlag.FP16)
+    serialized_engine = builder.build_serialized_network(network, config)
+    if serialized_engine is None:
+        raise RuntimeError("TensorRT failed to build the DepthPro engine")
+    
+    with open(engine_path, "wb") as engine_file:
+        engine_file.write(serialized_engine)
+    logger.info(f"DepthPro TensorRT engine saved to {engine_path}")
+
+
+class TensorRTDepthModel:
+    """DepthPro backed by a TensorRT engine, returning the same output type as the HF model"""
+    
+    def __init__(self, engine_path: str, device: str = "cuda"):
+        self.device = torch.device(device)
+        runtime = trt.Runtime(TRT_LOGGER)
+        with open(engine_path, "rb") as engine_file:
+            self.engine = runtime.deserialize_cuda_engine(engine_file.read())
+        if self.engine is None:
+            raise RuntimeError(f"Failed to load TensorRT engine from {engine_path}")
+        self.context = self.engine.create_execution_context()
+        # One execution context is shared, so calls from different worker threads are serialized
+        self._lock = threading.Lock()
+        self.output_names = [
+            self.engine.get_tensor_name(i)
+            for i in range(self.engine.num_io_tensors)
+            if self.engine.get_tensor_mode(self.engine.get_tensor_name(i)) == trt.TensorIOMode.OUTPUT
+        ]
+    
+    def __call__(self, pixel_values: torch.Tensor) -> DepthProDepthEstimatorOutput:
+        pixel_values = pixel_values.to(self.device, dtype=torch.float32).contiguous()
+        
+        with self._lock:
+            self.context.set_input_shape("pixel_values", tuple(pixel_values.shape))
+            self.context.set_tensor_address("pixel_values", pixel_values.data_ptr())
+            
+            outputs = {}
+            for name in self.output_names:
+                outputs[name] = torch.empty(
+                    tuple(self.context.get_tensor_shape(name)),
+                    dtype=TRT_TO_TORCH_DTYPE[self.engine.get_tensor_dtype(name)],
+                    device=self.device,
+                )
+                self.context.set_tensor_address(name, outputs[name].data_ptr())
+            
+            # Enqueue on the caller's current stream so stream ordering matches the eager model
+            if not self.context.execute_async_v3(torch.cuda.current_stream().cuda_stream):
+                raise RuntimeError("TensorRT DepthPro inference failed")
+        
+        return DepthProDepthEstimatorOutput(
+            predicted_depth=outputs["predicted_depth"],
+            field_of_view=outputs.get("field_of_view"),
+        )